@@ -15,71 +15,229 @@ Output:
 - data/processed/marketcap_monthly.csv
   Columns: date,name,value,category
   value is market cap in $B (billions USD).
+- data/processed/marketcap_monthly.parquet
+  Same rows, zstd-compressed, with date kept as a timestamp.
 
 Caveat:
 - This assumes constant shares outstanding derived from a single snapshot.
   It’s an approximation, but stable and reproducible for visualization.
 """
 
+import io
 import os
 import json
-import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import timedelta
 from pathlib import Path
 
+import numpy as np
+import orjson
 import pandas as pd
-import requests
-from pandas_datareader import data as pdr
+import pyarrow as pa
+import pyarrow.csv as pv
+import pyarrow.parquet as pq
+import requests_cache
+from requests.adapters import HTTPAdapter
+from requests.exceptions import RequestException
+from urllib3.util.retry import Retry
 
 
 ROOT = Path(__file__).resolve().parents[1]
 CONFIG_PATH = ROOT / "config" / "tickers.json"
 OUT_PATH = ROOT / "data" / "processed" / "marketcap_monthly.csv"
+PARQUET_PATH = OUT_PATH.with_suffix(".parquet")
+CACHE_DIR = ROOT / "data" / "cache"
+STOOQ_CACHE_DIR = CACHE_DIR / "stooq"
 
 FMP_STABLE_BASE = "https://financialmodelingprep.com/stable"
+FMP_BATCH_SIZE = 20
+STOOQ_CSV_URL = "https://stooq.com/q/d/l/"
+# Same 5-year window pandas-datareader's Stooq reader requested by default; the
+# constant-shares approximation gets worse the further back it is stretched.
+STOOQ_HISTORY = timedelta(days=5 * 365)
+
+MAX_WORKERS = 8
+# Caps concurrent FMP calls now that tickers are fetched in parallel
+# (replaces the old fixed sleep between sequential tickers).
+FMP_SLOTS = threading.Semaphore(5)
+# Set on the first 401 from FMP: the key itself is invalid and is not going to
+# start working mid-run, so the remaining tickers skip the request. 402/403 can
+# be per-symbol plan restrictions and only fail the ticker that got them.
+FMP_DENIED = threading.Event()
+FMP_DENIED_STATUSES = {401}
+
+# One pooled session for every Stooq/FMP call so worker threads reuse
+# keep-alive TLS connections instead of handshaking per request. Responses
+# are also cached on disk (SQLite), so reruns within the expiry window skip
+# the network; FMP snapshots expire sooner than the Stooq price history.
+# apikey is left out of cache keys (stable across key rotation) and is not
+# persisted in the cache file.
+SESSION = requests_cache.CachedSession(
+    str(CACHE_DIR / "http"),
+    backend="sqlite",
+    expire_after=timedelta(hours=12),
+    urls_expire_after={"financialmodelingprep.com": timedelta(hours=1)},
+    allowable_codes=(200,),
+    ignored_parameters=["apikey"],
+)
+SESSION.headers.update({
+    "User-Agent": "ai-hyperscalers-marketcap-race (github actions)",
+    "Accept": "application/json",
+})
+# Ride out transient rate limiting / upstream errors instead of losing the ticker.
+# Jitter spreads the retries of concurrent workers that were throttled together.
+# Non-transient statuses (401/402/403/404) are not retried and still surface
+# through raise_for_status().
+# Size the per-host pool to the worker count so no thread ever opens (and then
+# discards) an extra connection; only two hosts are involved.
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=MAX_WORKERS,
+    max_retries=Retry(
+        total=5,
+        backoff_factor=0.5,
+        backoff_jitter=0.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+        respect_retry_after_header=True,
+        allowed_methods=["GET"],
+    ),
+))
 
 
 def to_monthly_eom(df: pd.DataFrame, date_col: str) -> pd.DataFrame:
-    """Resample a daily time series to monthly end-of-month using last observation each month."""
-    df = df.copy()
-    df[date_col] = pd.to_datetime(df[date_col], errors="coerce")
-    df = df.dropna(subset=[date_col]).sort_values(date_col).set_index(date_col)
-    return df.resample("ME").last().dropna().reset_index()
+    """
+    Resample a daily time series to monthly end-of-month using last observation each month.
+
+    date_col must already be datetime64 (fetch_stooq_daily_close parses it at read time).
+    """
+    df = df.dropna().sort_values(date_col)
+
+    # Keep the last row per calendar month: unlike resample("ME") this never
+    # materialises bins for months with no observations. Rows are sorted, so a
+    # row is its month's last exactly when the next row's month differs.
+    months = df[date_col].values.astype("datetime64[M]")
+    keep = np.append(months[1:] != months[:-1], True)[: len(months)]
+    out = df[keep].reset_index(drop=True)
 
+    # Month-end label straight from the month codes (first of next month - 1 day),
+    # rather than applying a MonthEnd offset to every row.
+    next_month = months[keep] + np.timedelta64(1, "M")
+    out[date_col] = (next_month.astype("datetime64[D]") - np.timedelta64(1, "D")).astype("datetime64[ns]")
+    return out
 
-def fetch_stooq_daily_close(symbol: str) -> pd.DataFrame:
+
+def fetch_stooq_daily_close(symbol: str, start: pd.Timestamp | None = None) -> pd.DataFrame:
     """
-    Fetch daily close prices from Stooq via pandas-datareader.
+    Fetch daily close prices from Stooq's CSV download endpoint.
 
     Stooq uses lowercase tickers with suffix .us for US stocks, e.g. msft.us
+    Rows from start (default: today - STOOQ_HISTORY) through today are requested (d1/d2).
     """
     stooq_symbol = f"{symbol.lower()}.us"
-    df = pdr.DataReader(stooq_symbol, "stooq")  # Open/High/Low/Close/Volume
-    df = df.sort_index().reset_index().rename(columns={"Date": "date", "Close": "close"})
-    df["date"] = pd.to_datetime(df["date"], errors="coerce")
-    df["close"] = pd.to_numeric(df["close"], errors="coerce")
-    df = df.dropna(subset=["date", "close"])
-    return df[["date", "close"]]
+    today = pd.Timestamp.today().normalize()
+    if start is None:
+        start = today - STOOQ_HISTORY
+    params = {
+        "s": stooq_symbol,
+        "d1": start.strftime("%Y%m%d"),
+        "d2": today.strftime("%Y%m%d"),
+        "i": "d",
+    }
+    r = SESSION.get(STOOQ_CSV_URL, params=params, timeout=60)
+    r.raise_for_status()
 
+    # Unknown symbols come back as a plain-text "No data" body, not a CSV.
+    if not r.content.startswith(b"Date"):
+        raise RuntimeError(f"No Stooq data for {stooq_symbol}: {r.text[:200]}")
+
+    # Parse only the two columns used, straight from the raw bytes.
+    df = pd.read_csv(
+        io.BytesIO(r.content),
+        usecols=["Date", "Close"],
+        dtype={"Close": "float64"},
+        parse_dates=["Date"],
+        date_format="%Y-%m-%d",
+        engine="c",
+    )
+    df = df.rename(columns={"Date": "date", "Close": "close"})
+    return df.dropna(subset=["date", "close"])
+
+
+def load_cached_daily_close(symbol: str) -> pd.DataFrame | None:
+    """Load the cached daily closes for symbol, or None if absent/unreadable."""
+    path = STOOQ_CACHE_DIR / f"{symbol.lower()}.parquet"
+    if not path.exists():
+        return None
+    try:
+        return pd.read_parquet(path)
+    except Exception:
+        return None
+
+
+def fetch_stooq_daily_close_cached(symbol: str) -> pd.DataFrame:
+    """
+    Daily closes for symbol, pulling only the rows newer than the on-disk cache.
 
-def fetch_fmp_price_and_marketcap(symbol: str, api_key: str) -> tuple[float, float]:
+    The delta request starts at the last cached date so that day overlaps. Stooq
+    back-adjusts history for splits/dividends; if the overlapping close no longer
+    matches, or the delta request fails, the full series is re-pulled. Rows older
+    than STOOQ_HISTORY are dropped so the cache stays the size of a full pull.
     """
-    Fetch CURRENT price and CURRENT marketCap from FMP stable profile endpoint.
+    cached = load_cached_daily_close(symbol)
+    df = None
 
-    Returns: (price_now, marketcap_now)
+    if cached is not None and not cached.empty:
+        last = cached["date"].max()
+        try:
+            new = fetch_stooq_daily_close(symbol, start=last)
+        except (RuntimeError, RequestException):
+            new = None
+        if new is not None:
+            old_close = cached.loc[cached["date"] == last, "close"].iloc[-1]
+            overlap = new.loc[new["date"] == last, "close"]
+            if not overlap.empty and abs(overlap.iloc[-1] - old_close) <= 1e-9 * abs(old_close):
+                df = pd.concat([cached, new], ignore_index=True)
+                df = df.drop_duplicates("date", keep="last", ignore_index=True)
+                window_start = pd.Timestamp.today().normalize() - STOOQ_HISTORY
+                df = df[df["date"] >= window_start].reset_index(drop=True)
+
+    if df is None:
+        df = fetch_stooq_daily_close(symbol)
+
+    STOOQ_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    path = STOOQ_CACHE_DIR / f"{symbol.lower()}.parquet"
+    tmp = path.with_suffix(".parquet.tmp")
+    df.to_parquet(tmp, compression="zstd", index=False)
+    os.replace(tmp, path)
+    return df
+
+
+def fetch_fmp_profiles_raw(symbols: str, api_key: str) -> list:
+    """
+    GET the FMP stable profile endpoint for one symbol or a comma-separated batch.
+
+    Returns the decoded JSON list (one object per symbol FMP recognised).
     """
+    if FMP_DENIED.is_set():
+        raise PermissionError("FMP refused this API key earlier in the run; not retrying")
+
     url = f"{FMP_STABLE_BASE}/profile"
-    headers = {
-        "User-Agent": "ai-hyperscalers-marketcap-race (github actions)",
-        "Accept": "application/json",
-    }
-    r = requests.get(url, params={"symbol": symbol, "apikey": api_key}, headers=headers, timeout=60)
+    with FMP_SLOTS:
+        r = SESSION.get(url, params={"symbol": symbols, "apikey": api_key}, timeout=60)
+    if r.status_code in FMP_DENIED_STATUSES:
+        FMP_DENIED.set()
+        raise PermissionError(f"FMP returned HTTP {r.status_code} for {symbols}: {r.text[:200]}")
     r.raise_for_status()
 
-    js = r.json()
-    if not isinstance(js, list) or not js:
-        raise RuntimeError(f"Empty profile response for {symbol}: {str(js)[:200]}")
+    js = orjson.loads(r.content)
+    if not isinstance(js, list):
+        raise RuntimeError(f"Unexpected profile response for {symbols}: {str(js)[:200]}")
+    return js
 
-    obj = js[0]
+
+def parse_fmp_price_and_marketcap(obj: dict, symbol: str) -> tuple[float, float]:
+    """Validate one FMP profile object. Returns: (price_now, marketcap_now)"""
     price = obj.get("price")
     mcap = obj.get("marketCap")
 
@@ -97,6 +255,77 @@ def fetch_fmp_price_and_marketcap(symbol: str, api_key: str) -> tuple[float, flo
     return price, mcap
 
 
+def fetch_fmp_price_and_marketcap(symbol: str, api_key: str) -> tuple[float, float]:
+    """
+    Fetch CURRENT price and CURRENT marketCap from FMP stable profile endpoint.
+
+    Returns: (price_now, marketcap_now)
+    """
+    js = fetch_fmp_profiles_raw(symbol, api_key)
+    if not js:
+        raise RuntimeError(f"Empty profile response for {symbol}: {str(js)[:200]}")
+    return parse_fmp_price_and_marketcap(js[0], symbol)
+
+
+def fetch_fmp_snapshots(symbols: list[str], api_key: str) -> dict[str, tuple[float, float]]:
+    """
+    Batch the profile lookups: one request per FMP_BATCH_SIZE symbols.
+
+    Returns {SYMBOL: (price_now, marketcap_now)} for every symbol the batch
+    responses covered with valid data; callers fetch the rest individually.
+    """
+    snapshots = {}
+    for i in range(0, len(symbols), FMP_BATCH_SIZE):
+        chunk = [s.upper() for s in symbols[i:i + FMP_BATCH_SIZE]]
+        try:
+            objs = fetch_fmp_profiles_raw(",".join(chunk), api_key)
+        except (PermissionError, RuntimeError, ValueError, RequestException) as e:
+            print(f"FMP batch profile: failed ({e}); falling back to per-symbol calls")
+            continue
+        for obj in objs:
+            if not isinstance(obj, dict):
+                continue
+            sym = str(obj.get("symbol", "")).upper()
+            if sym not in chunk:
+                continue
+            try:
+                snapshots[sym] = parse_fmp_price_and_marketcap(obj, sym)
+            except (RuntimeError, ValueError, TypeError):
+                pass  # leave it to the per-symbol fallback, which reports the error
+    return snapshots
+
+
+def process_ticker(
+    t: dict, api_key: str, snapshot: tuple[float, float] | None = None
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Return (month-end dates, approximate market cap in $B) arrays for one ticker config entry.
+
+    snapshot is the (price_now, marketcap_now) pair from the batched FMP lookup;
+    when the batch did not cover this ticker it is fetched individually.
+    """
+    symbol = t["ticker"]
+
+    # 1) long price history (daily), topped up from the local cache
+    prices_daily = fetch_stooq_daily_close_cached(symbol)
+
+    # 2) monthly EOM closes
+    prices_m = to_monthly_eom(prices_daily, "date")  # date, close
+
+    # 3) current price + market cap snapshot
+    if snapshot is None:
+        snapshot = fetch_fmp_price_and_marketcap(symbol, api_key)
+    price_now, mcap_now = snapshot
+
+    # 4) derive constant shares
+    shares = mcap_now / price_now
+
+    # 5) compute approximate market cap history (in $B)
+    dates = prices_m["date"].to_numpy()  # datetime64; formatted once at write time
+    values = np.multiply(prices_m["close"].to_numpy(dtype=np.float64), shares / 1e9)
+    return dates, values
+
+
 def main() -> None:
     api_key = os.getenv("FMP_API_KEY", "").strip()
     if not api_key:
@@ -109,56 +338,78 @@ def main() -> None:
     if not tickers:
         raise RuntimeError("No tickers found in config/tickers.json")
 
-    rows = []
-    skipped = []
-
-    for t in tickers:
-        symbol = t["ticker"]
-        name = t.get("name", symbol)
-        category = t.get("category", "Unknown")
-
-        try:
-            # 1) long price history (daily)
-            prices_daily = fetch_stooq_daily_close(symbol)
-
-            # 2) monthly EOM closes
-            prices_m = to_monthly_eom(prices_daily, "date")  # date, close
+    # Fixed category sets from the config so name/category can be stored as
+    # small-integer categoricals rather than one Python string per row.
+    all_names = list(dict.fromkeys(t.get("name", t["ticker"]) for t in tickers))
+    all_cats = list(dict.fromkeys(t.get("category", "Unknown") for t in tickers))
 
-            # 3) current price + market cap snapshot
-            price_now, mcap_now = fetch_fmp_price_and_marketcap(symbol, api_key)
-
-            # 4) derive constant shares
-            shares = mcap_now / price_now
-
-            # 5) compute approximate market cap history (in $B)
-            prices_m["value"] = (prices_m["close"] * shares) / 1e9
-            prices_m["name"] = name
-            prices_m["category"] = category
-            prices_m["date"] = prices_m["date"].dt.strftime("%Y-%m-%d")
-
-            rows.append(prices_m[["date", "name", "value", "category"]])
-            print(f"{symbol}: OK (Stooq close × derived shares) rows={len(prices_m)}")
-
-        except Exception as e:
-            print(f"{symbol}: SKIP ({type(e).__name__}): {e}")
-            skipped.append(symbol)
-
-        time.sleep(0.25)
+    # Per-column chunks, concatenated once after the pool drains.
+    dates, values, name_codes, cat_codes = [], [], [], []
+    skipped = []
 
-    if not rows:
+    try:
+        snapshots = fetch_fmp_snapshots([t["ticker"] for t in tickers], api_key)
+    except Exception as e:
+        print(f"FMP batch profile: FAILED ({type(e).__name__}): {e}")
+        snapshots = {}
+    print(f"FMP batch profile: {len(snapshots)}/{len(tickers)} tickers covered")
+
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as ex:
+        futures = {
+            ex.submit(process_ticker, t, api_key, snapshots.get(t["ticker"].upper())): t
+            for t in tickers
+        }
+        for fut in as_completed(futures):
+            t = futures[fut]
+            symbol = t["ticker"]
+            try:
+                d, v = fut.result()
+                dates.append(d)
+                values.append(v)
+                name_codes.append(np.full(len(d), all_names.index(t.get("name", symbol))))
+                cat_codes.append(np.full(len(d), all_cats.index(t.get("category", "Unknown"))))
+                print(f"{symbol}: OK (Stooq close × derived shares) rows={len(d)}")
+            except Exception as e:
+                print(f"{symbol}: SKIP ({type(e).__name__}): {e}")
+                skipped.append(symbol)
+
+    if not dates:
         raise RuntimeError(f"All tickers failed. Skipped={skipped}")
 
-    out = pd.concat(rows, ignore_index=True)
-    out["value"] = pd.to_numeric(out["value"], errors="coerce")
-    out = out.dropna(subset=["date", "name", "value"])
-    out = out.sort_values(["date", "value"], ascending=[True, False])
+    # value is already a float from process_ticker; no to_numeric pass needed.
+    # The table is assembled straight from the concatenated arrays (no pandas
+    # frame in between): float32 is ample for $B market caps, name/category
+    # are dictionary-encoded against the config lists, and NaN values map to
+    # null. Null-dropping and ordering run in Arrow's C++ kernels.
+    table = (
+        pa.table({
+            "date": pa.array(np.concatenate(dates), type=pa.timestamp("ns")),
+            "name": pa.DictionaryArray.from_arrays(
+                pa.array(np.concatenate(name_codes), type=pa.int32()), all_names
+            ),
+            "value": pa.array(np.concatenate(values).astype("float32"), from_pandas=True),
+            "category": pa.DictionaryArray.from_arrays(
+                pa.array(np.concatenate(cat_codes), type=pa.int32()), all_cats
+            ),
+        })
+        .drop_null()
+        .sort_by([("date", "ascending"), ("value", "descending")])
+    )
+
+    # One vectorised cast at write time renders dates as YYYY-MM-DD in the CSV.
+    csv_table = table.set_column(
+        table.schema.get_field_index("date"), "date", table["date"].cast(pa.date32())
+    )
 
     OUT_PATH.parent.mkdir(parents=True, exist_ok=True)
-    out.to_csv(OUT_PATH, index=False)
+    pv.write_csv(csv_table, str(OUT_PATH))
+    # Typed sibling for non-browser consumers: date stays a timestamp column.
+    pq.write_table(table, str(PARQUET_PATH), compression="zstd")
 
-    print(f"\nWrote: {OUT_PATH} (rows={len(out):,})")
+    print(f"\nWrote: {OUT_PATH} (rows={table.num_rows:,})")
+    print(f"Wrote: {PARQUET_PATH}")
     if skipped:
-        print(f"Skipped tickers: {', '.join(skipped)}")
+        print(f"Skipped tickers: {', '.join(sorted(skipped))}")
 
 
 if __name__ == "__main__":